@@ -1,5 +1,25 @@
+import asyncio
+import os
+import struct
 import serial
 
+# fixed-parameter APT commands (6 byte header, destination 0x50, source 0x01)
+# prebuilt once here so the hot paths don't rebuild them on every call
+_CMD_GET_INFO        = b'\x05\x00\x00\x00\x50\x01' # MGMSG_HW_REQ_INFO
+_CMD_SET_ENABLE_ON   = b'\x10\x02\x00\x01\x50\x01' # MGMSG_MOD_SET_CHANENABLESTATE
+_CMD_SET_ENABLE_OFF  = b'\x10\x02\x00\x02\x50\x01' # MGMSG_MOD_SET_CHANENABLESTATE
+_CMD_REQ_ENABLE      = b'\x11\x02\x00\x00\x50\x01' # MGMSG_MOD_REQ_CHANENABLESTATE
+_CMD_IDENTIFY        = b'\x23\x02\x00\x00\x50\x01' # MGMSG_MOD_IDENTIFY
+_CMD_REQ_POS         = b'\x11\x04\x00\x00\x50\x01' # MGMSG_MOT_REQ_POSCOUNTER
+_CMD_REQ_STATUS_BITS = b'\x29\x04\x00\x00\x50\x01' # MGMSG_MOT_REQ_STATUSBITS
+_CMD_HOME            = b'\x43\x04\x00\x00\x50\x01' # MGMSG_MOT_MOVE_HOME
+# MGMSG_MOT_MOVE_ABSOLUTE header: 6 byte payload, destination 0x50 | 0x80
+_ABS_MOVE_HEADER     = b'\x53\x04\x06\x00\xd0\x01'
+
+# response layouts, precompiled so each parse is a single C-level unpack:
+_INFO_STRUCT = struct.Struct('<6xI8sHI60xH') # serial, model, type, fw, hw
+_POS_STRUCT  = struct.Struct('<6x2si')       # channel id, position counts
+
 class Controller:
     '''
     Basic device adaptor for thorlabs DDS100 compact 100 mm direct drive stage.
@@ -7,7 +27,9 @@ class Controller:
     Test code runs and seems robust.
     '''
     def __init__(
-        self, which_port, name='DDS100', verbose=True, very_verbose=False):
+        self, which_port, name='DDS100', force_home=False,
+        home_blocking=True, legacy_init=False,
+        verbose=True, very_verbose=False):
         self.name = name
         self.verbose = verbose
         self.very_verbose = very_verbose
@@ -19,10 +41,30 @@ class Controller:
             raise IOError(
                 '%s: no connection on port %s'%(self.name, which_port))
         if self.verbose: print(" done.")
-        self._get_info()
-        assert self.model_number == 'KBD101\x00\x00'
+        try: # bigger OS buffers -> no lost reply bytes if the read is late
+            self.port.set_buffer_size(rx_size=8192, tx_size=1024)
+        except (AttributeError, serial.SerialException):
+            pass # POSIX: buffer sizes are managed by the tty driver
+        self.port.rts = False # no flow control (APT convention)
+        self.port.dtr = False
+        self.port.inter_byte_timeout = None
+        try: # Linux: ASYNC_LOW_LATENCY ioctl -> tty layer delivers bytes
+            self.port.set_low_latency_mode(True) # promptly (no coalescing)
+        except (AttributeError, NotImplementedError, ValueError):
+            pass # not supported on this platform/driver -> no-op
+        self._set_ftdi_latency(1) # no-op for non-FTDI ports
+        self._rxbuf = bytearray(128) # shared buffer for every response
+        self._homing = False
+        if legacy_init: # sequential handshake (one round trip per command)
+            self._get_info()
+            self._set_enable(True)
+            self._get_homed_status()
+        else:           # pipelined handshake (a single round trip)
+            self._pipelined_init()
+        assert self.model_number_bytes == b'KBD101\x00\x00'
         assert self.firmware_v == 131080
         self.EncCnt_per_mm = 2000
+        self._mm_per_count = 1 / self.EncCnt_per_mm # multiply, don't divide
         # these stages seem to hang or produce encoder overflow at the max
         # and min positions 'self.offset_mm' is an attempt to aviod these errors
         self.offset_mm = 1
@@ -30,63 +72,193 @@ class Controller:
         self.position_min_mm = 0  # 0  corresponds to +1mm
         self.position_max_mm = 98 # 98 corresponds to +99mm
         self.position_tol_mm = 0.05 # tolerance window for relative moves
-        self._set_enable(True)
-        self._get_homed_status()
-        if not self._homed:
-            self._home()
-        self.get_position_mm()
+        # legal range in counts (offset removed) -> per-move bound checks
+        # are then single integer compares instead of float arithmetic
+        self._min_counts = int(round(
+            (self.position_min_mm - self.position_tol_mm)
+            * self.EncCnt_per_mm))
+        self._max_counts = int(round(
+            (self.position_max_mm + self.position_tol_mm)
+            * self.EncCnt_per_mm))
         self._moving = False
-        self.move_mm(0, relative=False)
+        self._move_buf = bytearray(12) # reused for every move command
+        self._move_buf[:6] = _ABS_MOVE_HEADER
+        if force_home or not self._homed: # skip the slow home on warm start
+            self._home_submit()
+            # wait_for_home() finishes init (position read + move to 0);
+            # with home_blocking=False the caller reaps it later
+            if home_blocking:
+                self.wait_for_home()
+        else:
+            self.get_position_mm()
+            self.move_mm(0, relative=False)
+
+    def _set_ftdi_latency(self, ms):
+        # the KBD101 has an FTDI USB-serial chip with a default 'latency
+        # timer' of 16ms -> every short command/response round trip then
+        # waits ~16ms for the chip to flush the packet. Setting the timer
+        # to 1ms makes the many small exchanges here ~15x faster.
+        if self.very_verbose:
+            print('%s: setting FTDI latency timer = %ims'%(self.name, ms))
+        try:
+            if os.name == 'posix': # Linux: write to the sysfs entry
+                tty = os.path.basename(self.port.port)
+                latency_timer = (
+                    '/sys/bus/usb-serial/devices/%s/latency_timer'%tty)
+                with open(latency_timer, 'w') as file:
+                    file.write('%i'%ms)
+            if os.name == 'nt': # Windows: only ever touch our own device
+                import ctypes, winreg
+                from serial.tools import list_ports
+                serial_number = None
+                for p in list_ports.comports():
+                    if p.device == self.port.port:
+                        serial_number = p.serial_number
+                try: # FTDI D2XX driver dll: open by serial number so an
+                    # unrelated FTDI device is never reconfigured
+                    assert serial_number is not None
+                    ftd2xx = ctypes.windll.LoadLibrary('ftd2xx.dll')
+                    handle = ctypes.c_void_p()
+                    assert ftd2xx.FT_OpenEx( # 1 = FT_OPEN_BY_SERIAL_NUMBER
+                        serial_number.encode('ascii'), 1,
+                        ctypes.byref(handle)) == 0
+                    ftd2xx.FT_SetLatencyTimer(handle, ms)
+                    ftd2xx.FT_Close(handle)
+                except Exception: # VCP driver holds the device -> set the
+                    # registry key for the entry matching our COM port
+                    # (takes effect on the next re-enumeration)
+                    ftdibus = winreg.OpenKey(
+                        winreg.HKEY_LOCAL_MACHINE,
+                        'SYSTEM\\CurrentControlSet\\Enum\\FTDIBUS')
+                    for i in range(winreg.QueryInfoKey(ftdibus)[0]):
+                        device_parameters = winreg.OpenKey(
+                            ftdibus,
+                            winreg.EnumKey(ftdibus, i)
+                            + '\\0000\\Device Parameters',
+                            0, winreg.KEY_READ | winreg.KEY_SET_VALUE)
+                        port_name = winreg.QueryValueEx(
+                            device_parameters, 'PortName')[0]
+                        if port_name == self.port.port:
+                            winreg.SetValueEx(
+                                device_parameters, 'LatencyTimer', 0,
+                                winreg.REG_DWORD, ms)
+                        winreg.CloseKey(device_parameters)
+                    winreg.CloseKey(ftdibus)
+        except Exception: # not an FTDI port (or no permission) -> no-op
+            if self.very_verbose:
+                print('%s: -> failed to set FTDI latency timer'%self.name)
+            return None
+        if self.very_verbose:
+            print('%s: -> done setting FTDI latency timer'%self.name)
+        return None
+
+    def _read_exact(self, n):
+        # collect exactly n bytes into the shared receive buffer -> no
+        # fresh bytes object per command (pyserial only returns short on
+        # timeout, which is an error for the fixed-size APT replies).
+        # NOTE: callers must parse the returned memoryview before the next
+        # read re-uses the buffer (copy any slice they want to keep)
+        if n > len(self._rxbuf): # only for very large position batches
+            self._rxbuf = bytearray(n)
+        response = memoryview(self._rxbuf)[:n]
+        bytes_read = self.port.readinto(response)
+        assert bytes_read == n, '%s: read %i of %i bytes'%(
+            self.name, bytes_read, n)
+        return response
+
+    def _send_noread(self, cmd):
+        # write only -> lets several commands queue up on the controller so
+        # that a single read can collect the responses (one latency window
+        # instead of one per command)
+        if self._homing: self.wait_for_home() # reap a deferred home first
+        if self.very_verbose: print('%s: sending cmd ='%self.name, cmd)
+        self.port.write(cmd)
+        return None
 
     def _send(self, cmd, response_bytes=None):
+        if self._homing: self.wait_for_home() # reap a deferred home first
         if self.very_verbose: print('%s: sending cmd ='%self.name, cmd)
         self.port.write(cmd)
         if response_bytes is not None:
-            response = self.port.read(response_bytes)
+            response = self._read_exact(response_bytes)
         else:
             response = None
-        assert self.port.inWaiting() == 0
-        if self.very_verbose: print('%s: -> response = '%self.name, response)
+        if __debug__ and self.very_verbose: # skip the extra ioctl/syscall
+            assert self.port.inWaiting() == 0
+        if self.very_verbose:
+            print('%s: -> response = '%self.name,
+                  None if response is None else bytes(response))
         return response
 
-    def _get_info(self): # MGMSG_HW_REQ_INFO
-        if self.verbose:
-            print('%s: getting info'%self.name)
-        cmd = b'\x05\x00\x00\x00\x50\x01'
-        response = self._send(cmd, response_bytes=90)
-        self.model_number = response[10:18].decode('ascii')
-        self.type = int.from_bytes(response[18:20], byteorder='little')
-        self.serial_number = int.from_bytes(response[6:10], byteorder='little')
-        self.firmware_v = int.from_bytes(response[20:24], byteorder='little')
-        self.hardware_v = int.from_bytes(response[84:86], byteorder='little')
+    def _parse_info(self, response):
+        (self.serial_number, self.model_number_bytes, self.type,
+         self.firmware_v, self.hardware_v) = _INFO_STRUCT.unpack_from(
+             response)
         if self.verbose:
             print('%s: -> model number  = %s'%(self.name, self.model_number))
             print('%s: -> type          = %s'%(self.name, self.type))
             print('%s: -> serial number = %s'%(self.name, self.serial_number))
             print('%s: -> firmware version = %s'%(self.name, self.firmware_v))
             print('%s: -> hardware version = %s'%(self.name, self.hardware_v))
+        return None
+
+    def _get_info(self): # MGMSG_HW_REQ_INFO
+        if self.verbose:
+            print('%s: getting info'%self.name)
+        response = self._send(_CMD_GET_INFO, response_bytes=90)
+        self._parse_info(response)
         return response
 
-    def _get_enable(self): # MGMSG_MOD_REQ_CHANENABLESTATE
+    def _pipelined_init(self):
+        # the KBD101 queues commands, so the whole startup handshake (info
+        # -> enable set -> enable verify -> homed status) can go out in one
+        # write and come back in one read -> the USB latency is paid once
+        # instead of four times (home is handled separately because it can
+        # take seconds)
         if self.verbose:
-            print('%s: getting enable'%self.name)
-        cmd = b'\x11\x02\x00\x00\x50\x01'
-        response = self._send(cmd, response_bytes=6)
+            print('%s: getting info (pipelined init)'%self.name)
+        self._send_noread(_CMD_GET_INFO + _CMD_SET_ENABLE_ON
+                          + _CMD_REQ_ENABLE + _CMD_REQ_STATUS_BITS)
+        response = self._read_exact(90 + 6 + 12)
+        self._parse_info(response)
+        assert self._parse_enable(response[90:96]) == True
+        self._homed = bool(response[105] & 4) # bit mask 0x00000400 = homed
+        if self.verbose:
+            print('%s: -> enable = %s'%(self.name, self.enable))
+            print('%s: -> homed = %s'%(self.name, self._homed))
+        return None
+
+    @property
+    def model_number(self): # decode on access, init compares raw bytes
+        return self.model_number_bytes.decode('ascii')
+
+    def _parse_enable(self, response):
         assert int(response[3]) in (1, 2)
         if int(response[3]) == 1: self.enable = True
         if int(response[3]) == 2: self.enable = False
+        return self.enable
+
+    def _get_enable(self): # MGMSG_MOD_REQ_CHANENABLESTATE
+        if self.verbose:
+            print('%s: getting enable'%self.name)
+        response = self._send(_CMD_REQ_ENABLE, response_bytes=6)
+        self._parse_enable(response)
         if self.verbose:
             print('%s: -> enable = %s'%(self.name, self.enable))
         return self.enable
 
     def _set_enable(self, enable): # MGMSG_MOD_SET_CHANENABLESTATE
         assert enable in (True, False)
-        if enable:     cmd = b'\x10\x02\x00\x01\x50\x01'
-        if not enable: cmd = b'\x10\x02\x00\x02\x50\x01'
+        if enable:     cmd = _CMD_SET_ENABLE_ON
+        if not enable: cmd = _CMD_SET_ENABLE_OFF
         if self.verbose:
             print('%s: setting enable = %s'%(self.name, enable))
-        self._send(cmd)
-        assert self._get_enable() == enable
+        # pipeline the 'set' with the 'request' for verification -> a single
+        # round trip pays the USB latency once instead of twice
+        self._send_noread(cmd)
+        self._send_noread(_CMD_REQ_ENABLE)
+        response = self._read_exact(6)
+        assert self._parse_enable(response) == enable
         if self.verbose:
             print('%s: done setting enable'%self.name)
         return None
@@ -94,77 +266,184 @@ class Controller:
     def _get_homed_status(self): # MGMSG_MOT_REQ_STATUSBITS
         if self.verbose:
             print('%s: getting homed status...'%self.name)
-        cmd = b'\x29\x04\x00\x00\x50\x01'
-        status_bits = self._send(cmd, response_bytes=12)[8:]
+        status_bits = self._send(_CMD_REQ_STATUS_BITS, response_bytes=12)[8:]
         self._homed = bool(status_bits[1] & 4) # bit mask 0x00000400 = homed
         if self.verbose:
             print('%s: -> homed = %s'%(self.name, self._homed))
         return self._homed
 
-    def _home(self): # MGMSG_MOT_MOVE_HOME
+    def _home_submit(self): # MGMSG_MOT_MOVE_HOME
         if self.verbose:
             print('%s: homing stage...'%self.name)
-        cmd = b'\x43\x04\x00\x00\x50\x01'
+        self._send_noread(_CMD_HOME)
+        self._homing = True
+        return None
+
+    def _home_wait(self):
+        self._homing = False # clear first: _get_homed_status() re-enters
         # response_bytes=6 is not documented, discovered by trial and error
         # when the 6 bytes return it seems like the home routine is finished!
-        self._send(cmd, response_bytes=6)
+        self._read_exact(6)
         assert self._get_homed_status()
         if self.verbose:
             print('%s: -> done homing stage'%self.name)
         return None
 
+    def _home(self):
+        self._home_submit()
+        self._home_wait()
+        return None
+
+    def wait_for_home(self):
+        # reap a deferred home (home_blocking=False) once the caller has
+        # finished staging other work -> also finishes deferred init
+        if not self._homing: return
+        self._home_wait()
+        self.get_position_mm()
+        self.move_mm(0, relative=False)
+        return None
+
     def identify(self): # MGMSG_MOD_IDENTIFY
         if self.verbose:
             print('%s: -> flashing front panel LEDs'%self.name)
-        cmd = b'\x23\x02\x00\x00\x50\x01'
-        response = self._send(cmd)
+        response = self._send(_CMD_IDENTIFY)
         return response
 
     def get_position_mm(self): # MGMSG_MOT_REQ_POSCOUNTER
         if self.verbose:
             print('%s: getting position'%self.name)
-        cmd = b'\x11\x04\x00\x00\x50\x01'
-        response = self._send(cmd, response_bytes=12)
-        self.ch_id_bytes = response[6:8]
-        position_counts = int.from_bytes(response[8:12], byteorder='little')
+        response = self._send(_CMD_REQ_POS, response_bytes=12)
+        self.ch_id_bytes, position_counts = _POS_STRUCT.unpack_from(response)
         self.position_counts = position_counts - self.offset_counts
-        self.position_mm = self.position_counts / self.EncCnt_per_mm
+        self.position_mm = self.position_counts * self._mm_per_count
         if self.verbose:
             print('%s: -> position = %0.4fmm'%(self.name, self.position_mm))
         return self.position_mm
 
+    def _poll_position_mm(self):
+        # minimal-overhead poll for fast stage-follow loops (>100Hz where
+        # Python per-call overhead starts to matter): no prints, no state
+        # updates, one unpack and one multiply -> use get_position_mm()
+        # for the verbose/stateful version
+        if self._homing: self.wait_for_home()
+        self.port.write(_CMD_REQ_POS)
+        response = self._read_exact(12)
+        return ((_POS_STRUCT.unpack_from(response)[1] - self.offset_counts)
+                * self._mm_per_count)
+
+    def get_positions_mm(self, n):
+        # batch n position polls into one write and one read -> the
+        # per-message USB latency is paid once instead of n times (useful
+        # for tracking the stage during a move, e.g. a UI progress bar)
+        if self.verbose:
+            print('%s: getting %i positions'%(self.name, n))
+        self._send_noread(_CMD_REQ_POS * n)
+        response = self._read_exact(12 * n)
+        positions_mm = []
+        for self.ch_id_bytes, position_counts in _POS_STRUCT.iter_unpack(
+            response):
+            self.position_counts = position_counts - self.offset_counts
+            self.position_mm = self.position_counts * self._mm_per_count
+            positions_mm.append(self.position_mm)
+        if self.verbose:
+            print('%s: -> positions = %s'%(self.name, positions_mm))
+        return positions_mm
+
     def _finish_move(self):
         if not self._moving: return
-        self.port.read(20) # collect bytes to confirm move (could parse too...)
+        # read APT messages (6 byte header + optional payload) until the
+        # controller confirms the move -> no stale bytes are left in the
+        # buffer and a short/odd message can't hang until the 15s timeout
+        while True:
+            header = self._read_exact(6)
+            msg_id, length = struct.unpack('<HH', header[0:4])
+            if header[4] & 0x80: # 'long' message -> read the payload too
+                self._read_exact(length)
+            if msg_id in (0x0464, 0x0466): # MOVE_COMPLETED, MOVE_STOPPED
+                break
         self.get_position_mm()
         # check position is sane and counter overflow has been avioded
-        assert self.position_mm >= self.position_min_mm - self.position_tol_mm
-        assert self.position_mm <= self.position_max_mm + self.position_tol_mm
+        assert self._min_counts <= self.position_counts <= self._max_counts
         self._moving = False
         if self.verbose:
             print('%s: -> finished moving'%(self.name))
         return None
 
     def move_mm(self, move_mm, relative=True, block=True):
+        # reap a deferred home before touching position_mm/ch_id_bytes
+        # (they don't exist until wait_for_home() finishes the init)
+        if self._homing: self.wait_for_home()
         if self._moving: self._finish_move()
         if self.verbose:
             print('%s: moving = %0.4fmm (relative=%s)'%(
                 self.name, move_mm, relative))
         if relative: move_mm = self.position_mm + move_mm
-        assert move_mm >= self.position_min_mm - self.position_tol_mm
-        assert move_mm <= self.position_max_mm + self.position_tol_mm
         position_counts = int(round(move_mm * self.EncCnt_per_mm)) # integer
+        assert self._min_counts <= position_counts <= self._max_counts
         position_counts = position_counts + self.offset_counts # add offset
-        # MGMSG_MOT_MOVE_ABSOLUTE
-        d = bytes([b'\x50'[0] | b'\x80'[0]]) # 'destination byte'
-        p = position_counts.to_bytes(4, byteorder='little', signed=True)
-        cmd = (b'\x53\x04\x06\x00' + d + b'\x01' + self.ch_id_bytes + p)
+        # MGMSG_MOT_MOVE_ABSOLUTE, packed into the reused buffer so
+        # steady-state moves allocate nothing and issue a single write
+        cmd = self._move_buf
+        cmd[6:8] = self.ch_id_bytes
+        struct.pack_into('<i', cmd, 8, position_counts)
         self._send(cmd)
         self._moving = True
         if block:
             self._finish_move()
         return None
 
+    def move_mm_sequence(self, moves_mm, relative=True):
+        # submit every move up front, then collect the completion messages
+        # -> the per-move USB latency overlaps with the next submission
+        # instead of each move blocking until it finishes
+        if self._homing: self.wait_for_home() # reap a deferred home first
+        if self._moving: self._finish_move()
+        moves_mm = list(moves_mm) # materialize (could be an iterator)
+        if self.verbose:
+            print('%s: moving sequence = %s (relative=%s)'%(
+                self.name, moves_mm, relative))
+        position_mm, submitted = self.position_mm, 0
+        for move_mm in moves_mm:
+            if relative: position_mm = position_mm + move_mm
+            else:        position_mm = move_mm
+            position_counts = int(round(position_mm * self.EncCnt_per_mm))
+            assert self._min_counts <= position_counts <= self._max_counts
+            cmd = self._move_buf
+            cmd[6:8] = self.ch_id_bytes
+            struct.pack_into(
+                '<i', cmd, 8, position_counts + self.offset_counts)
+            self._send_noread(cmd)
+            submitted += 1
+        self._moving = True
+        while submitted: # drain one completion message per submitted move
+            header = self._read_exact(6)
+            msg_id, length = struct.unpack('<HH', header[0:4])
+            if header[4] & 0x80: # 'long' message -> read the payload too
+                self._read_exact(length)
+            if msg_id in (0x0464, 0x0466): # MOVE_COMPLETED, MOVE_STOPPED
+                submitted -= 1
+        self._moving = False
+        self.get_position_mm()
+        assert self._min_counts <= self.position_counts <= self._max_counts
+        if self.verbose:
+            print('%s: -> finished moving sequence'%self.name)
+        return None
+
+    async def _finish_move_async(self):
+        # run the blocking serial read on a worker thread so other
+        # coroutines (e.g. camera or illumination control) keep running
+        # while the stage moves
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._finish_move)
+        return None
+
+    async def move_mm_async(self, move_mm, relative=True):
+        # awaitable version of move_mm -> wrap in asyncio.create_task() to
+        # overlap the move with other device I/O
+        self.move_mm(move_mm, relative=relative, block=False)
+        await self._finish_move_async()
+        return None
+
     def close(self):
         if self.verbose: print("%s: closing..."%self.name, end=' ')
         self.port.close()
@@ -190,6 +469,9 @@ if __name__ == '__main__':
     for moves in range(3):
         move = stage.move_mm(-20)
 
+    print('\n# A pipelined sequence of moves (submit all, then finish):')
+    stage.move_mm_sequence((20, 60, 0), relative=False)
+
     print('\n# Some random absolute moves:')
     from random import uniform
     for moves in range(3):